@@ -10,131 +10,437 @@ Steps:
 """
 
 import argparse
+import datetime
+import gzip
+import hashlib
 import json
 import os
+import pickle
 import re
+import shutil
 import sys
+import tempfile
+import threading
 import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import Dict, List, Tuple, cast
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, List, Sequence, Tuple, Union, cast
 
 import openpyxl
+from openpyxl.packaging.manifest import Manifest
 from openpyxl.worksheet.worksheet import Worksheet
+from openpyxl.writer.excel import ExcelWriter
+from openpyxl.xml.constants import ARC_CONTENT_TYPES, SHEET_MAIN_NS
+from openpyxl.xml.functions import fromstring
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+try:
+    from python_calamine import CalamineWorkbook
+except ImportError:  # optional, faster extract_domains
+    CalamineWorkbook = None  # type: ignore[assignment,misc]
 
-DOMAIN_PATTERN = re.compile(r"[A-Za-z0-9.-]+\.[A-Za-z]{2,}")
+if TYPE_CHECKING:
+    import httpx
 
+try:
+    from orjson import loads as json_loads
+except ImportError:  # optional, faster JSON decoding
+    from json import loads as json_loads
+
+
+DOMAIN_PATTERN = re.compile(r"[A-Za-z0-9.-]+\.[A-Za-z]{2,}")
+CACHE_FIELDS = ["domain", "status_code", "error_header", "body"]
+SUCCESS_FIELDS = ["domain", "icp_name", "icp_num", "sitename", "service", "status"]
+CSV_BUFFER_SIZE = 1 << 20
+RETRY_TOTAL = 3
+RETRY_BACKOFF = 0.3
+RETRY_STATUSES = (429, 502, 503, 504)
+HttpClient = Union[requests.Session, "httpx.Client"]
 
-def extract_domains(workbook_path: Path, link_header: str = "链接") -> List[str]:
-    wb = openpyxl.load_workbook(workbook_path, data_only=True, read_only=True)
-    ws = cast(Worksheet, wb.active)
-    rows = ws.iter_rows(values_only=True)
-    try:
-        header = next(rows)
-    except StopIteration:
-        return []
 
-    # Locate column
-    col_idx = None
+def find_link_column(header: Sequence[Any], link_header: str) -> int:
     for idx, val in enumerate(header):
         if val == link_header:
-            col_idx = idx
-            break
-    if col_idx is None:
-        col_idx = 0  # fallback to first column
-
-    seen = set()
-    domains: List[str] = []
-    for row in rows:
-        if col_idx >= len(row):
-            continue
-        cell_val = row[col_idx]
+            return idx
+    return 0  # fallback to first column
+
+
+def collect_domains(column: Iterable[Any]) -> Tuple[List[str], Dict[int, str]]:
+    search = DOMAIN_PATTERN.search  # bound once for the loop
+    row_to_domain: Dict[int, str] = {}
+    for row_idx, cell_val in enumerate(column, 2):
         if cell_val is None:
             continue
         text = str(cell_val).strip()
-        m = DOMAIN_PATTERN.search(text)
-        domain = m.group(0).lower() if m else text.lower()
-        if domain not in seen:
-            seen.add(domain)
-            domains.append(domain)
-    return domains
+        if not text:
+            continue
+        m = search(text)
+        row_to_domain[row_idx] = m.group(0).lower() if m else text.lower()
+    # dedup, keeping sheet order
+    return list(dict.fromkeys(row_to_domain.values())), row_to_domain
+
+
+def active_sheet_index(workbook_path: Path) -> int:
+    # the sheet openpyxl returns as wb.active
+    from openpyxl.reader.excel import _find_workbook_part
+
+    with zipfile.ZipFile(workbook_path) as archive:
+        package = Manifest.from_tree(fromstring(archive.read(ARC_CONTENT_TYPES)))
+        root = fromstring(archive.read(_find_workbook_part(package).PartName.lstrip("/")))
+    view = root.find(f"{{{SHEET_MAIN_NS}}}bookViews/{{{SHEET_MAIN_NS}}}workbookView")
+    return int(view.get("activeTab", 0)) if view is not None else 0
+
+
+def _calamine_value(value: Any) -> Any:
+    # match the values openpyxl returns
+    if value == "":
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+        return datetime.datetime.combine(value, datetime.time())
+    return value
+
+
+def _extract_domains_calamine(workbook_path: Path, link_header: str) -> Tuple[List[str], Dict[int, str]]:
+    with CalamineWorkbook.from_path(str(workbook_path)) as wb:
+        sheet = wb.get_sheet_by_index(active_sheet_index(workbook_path))
+        # keep leading empty rows/columns so indexes line up with sheet rows
+        rows = sheet.to_python(skip_empty_area=False)
+    if not rows:
+        return [], {}
+    col_idx = find_link_column(rows[0], link_header)
+    return collect_domains(_calamine_value(row[col_idx]) if col_idx < len(row) else None for row in rows[1:])
+
+
+def extract_domains(workbook_path: Path, link_header: str = "链接") -> Tuple[List[str], Dict[int, str]]:
+    if CalamineWorkbook is not None:
+        try:
+            return _extract_domains_calamine(workbook_path, link_header)
+        except Exception:
+            pass  # fall back to openpyxl
+
+    # data_only: formula cells give Excel's cached value, never the formula text
+    wb = openpyxl.load_workbook(workbook_path, data_only=True, read_only=True)
+    try:
+        ws = cast(Worksheet, wb.active)
+        # the <dimension> tag may be wrong
+        ws.reset_dimensions()
+        try:
+            header = next(ws.iter_rows(max_row=1, values_only=True))
+        except StopIteration:
+            return [], {}
+        col_idx = find_link_column(header, link_header)
+        # only materialize the link column
+        column = ws.iter_rows(min_row=2, min_col=col_idx + 1, max_col=col_idx + 1, values_only=True)
+        return collect_domains(cell_val for (cell_val,) in column)
+    finally:
+        # read-only workbooks keep the zip open until closed
+        wb.close()
 
 
-def load_cache(cache_path: Path) -> Dict[str, Dict[str, str]]:
+def parse_status_code(value: str) -> int:
+    # int in memory; csv.writer stringifies it back
+    try:
+        return int(value)
+    except ValueError:
+        return -1
+
+
+def load_cache(cache_path: Path) -> Dict[str, Dict[str, Any]]:
     if not cache_path.exists():
         return {}
     import csv
 
-    with cache_path.open(encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        return {row["domain"]: row for row in reader if "domain" in row}
+    # bodies may exceed the default field size limit
+    csv.field_size_limit(2**31 - 1)
+    # utf-8-sig accepts Excel's BOM; surrogateescape keeps stray non-UTF-8 bytes
+    with cache_path.open(encoding="utf-8-sig", errors="surrogateescape", newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if not header or "domain" not in header:
+            return {}
+        # index by position instead of building a dict per row
+        positions = {name: i for i, name in enumerate(header)}
+        missing = len(header)  # absent columns read as ""
+        d_i, s_i, e_i, b_i = (positions.get(name, missing) for name in CACHE_FIELDS)
+        width = max(d_i, s_i, e_i, b_i) + 1
+        cache: Dict[str, Dict[str, Any]] = {}
+        for row in reader:
+            if not row:
+                continue
+            if len(row) < width:
+                row += [""] * (width - len(row))
+            cache[row[d_i]] = {
+                "domain": row[d_i],
+                "status_code": parse_status_code(row[s_i]),
+                "error_header": row[e_i],
+                "body": row[b_i],
+            }
+        return cache
 
 
 def parse_success(body: str):
     try:
-        data = json.loads(body)
+        data = json_loads(body)
     except Exception:
-        return None
+        # orjson rejects lone surrogates, json accepts them
+        try:
+            data = json.loads(body)
+        except Exception:
+            return None
     if not isinstance(data, dict) or data.get("code") != 1:
         return None
     return data.get("data") or {}
 
 
-def call_api(domain: str, appcode: str, host: str, path: str, session: requests.Session):
-    url = f"{host}{path}"
-    resp = session.get(url, params={"domain": domain}, headers={"Authorization": f"APPCODE {appcode}"}, timeout=10)
+def parse_cache_row(row: Dict[str, Any]):
+    if row.get("status_code") != 200:
+        return None
+    return parse_success(row.get("body", ""))
+
+
+def make_session(pool_size: int) -> requests.Session:
+    retry = Retry(
+        total=RETRY_TOTAL,
+        backoff_factor=RETRY_BACKOFF,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=["GET"],
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def make_http2_client(pool_size: int):
+    import httpx
+
+    class RetryTransport(httpx.HTTPTransport):
+        # httpx only retries connect errors; add make_session's status retries
+        def handle_request(self, request: httpx.Request) -> httpx.Response:
+            for attempt in range(RETRY_TOTAL):
+                response = super().handle_request(request)
+                if response.status_code not in RETRY_STATUSES:
+                    return response
+                retry_after = response.headers.get("Retry-After", "")
+                response.close()
+                # like urllib3: first retry at once, then exponential backoff
+                time.sleep(float(retry_after) if retry_after.isdigit() else RETRY_BACKOFF * 2**attempt if attempt else 0)
+            return super().handle_request(request)
+
+    limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+    transport = RetryTransport(http2=True, retries=RETRY_TOTAL, limits=limits)
+    # requests follows redirects by default, httpx does not
+    return httpx.Client(transport=transport, follow_redirects=True)
+
+
+def call_api(domain: str, url: str, headers: Dict[str, str], session: HttpClient):
+    # the endpoint takes one domain per request; there is no batch form
+    resp = session.get(url, params={"domain": domain}, headers=headers, timeout=10)
     return {
         "domain": domain,
-        "status_code": str(resp.status_code),
+        "status_code": resp.status_code,
         "error_header": resp.headers.get("X-Ca-Error-Message", ""),
         "body": resp.text,
     }
 
 
-def rewrite_cache(cache_path: Path, all_domains: List[str], rows_by_domain: Dict[str, Dict[str, str]]):
+class RateLimiter:
+    # spaces call starts at least `interval` seconds apart across threads
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def wait(self):
+        if self.interval <= 0:
+            return
+        # reserve a slot under the lock, sleep outside it
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def call_api_paced(domain: str, url: str, headers: Dict[str, str], session: HttpClient, limiter: RateLimiter):
+    limiter.wait()
+    return call_api(domain, url, headers, session)
+
+
+def iter_api_results(
+    domains: List[str],
+    url: str,
+    headers: Dict[str, str],
+    session: HttpClient,
+    workers: int,
+    limiter: RateLimiter,
+):
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = {executor.submit(call_api_paced, dom, url, headers, session, limiter): dom for dom in domains}
+        for future in as_completed(futures):
+            dom = futures[future]
+            try:
+                row = future.result()
+            except Exception as e:
+                row = {
+                    "domain": dom,
+                    "status_code": -1,
+                    "error_header": type(e).__name__,
+                    "body": str(e),
+                }
+            yield dom, row
+    finally:
+        # drop queued calls if the caller stops early
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def rewrite_cache(cache_path: Path, all_domains: List[str], rows_by_domain: Dict[str, Dict[str, Any]]):
     import csv
 
-    fieldnames = ["domain", "status_code", "error_header", "body"]
-    with cache_path.open("w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        for dom in all_domains:
-            row = rows_by_domain.get(dom)
-            if row:
-                writer.writerow(row)
+    rows = [
+        [row.get(name, "") for name in CACHE_FIELDS]
+        for row in (rows_by_domain.get(dom) for dom in all_domains)
+        if row
+    ]
+    with cache_path.open("w", newline="", encoding="utf-8", errors="surrogateescape", buffering=CSV_BUFFER_SIZE) as f:
+        writer = csv.writer(f)
+        writer.writerow(CACHE_FIELDS)
+        writer.writerows(rows)
+
+
+def load_cache_pickle(cache_path: Path) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+    # only open caches this script wrote
+    with gzip.open(cache_path, "rb") as f:
+        data = pickle.load(f)
+    if not isinstance(data, dict) or not isinstance(data.get("rows"), dict) or not isinstance(data.get("parsed"), dict):
+        raise ValueError("unexpected pickle cache layout")
+    return data["rows"], data["parsed"]
+
+
+def rewrite_cache_pickle(
+    cache_path: Path,
+    all_domains: List[str],
+    rows_by_domain: Dict[str, Dict[str, Any]],
+    parsed_by_domain: Dict[str, Dict[str, Any]],
+):
+    rows = {dom: rows_by_domain[dom] for dom in all_domains if dom in rows_by_domain}
+    parsed = {dom: parsed_by_domain[dom] for dom in rows if dom in parsed_by_domain}
+
+    def write(tmp_name: str):
+        # level 1: faster, barely larger
+        with gzip.open(tmp_name, "wb", compresslevel=1) as f:
+            pickle.dump({"rows": rows, "parsed": parsed}, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    replace_atomic(cache_path, write)
+
+
+def load_cache_entries(
+    cache_path: Path, use_pickle: bool, warn: Callable[[str], None]
+) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, Dict[str, Any]], bool]:
+    if use_pickle:
+        if cache_path.exists():
+            try:
+                rows, parsed = load_cache_pickle(cache_path)
+                return rows, parsed, False
+            except Exception as exc:
+                warn(f"缓存文件损坏，改用 CSV 缓存重建：{cache_path}（{exc}）")
+        # seed from the CSV cache so paid lookups are not repeated
+        csv_path = cache_path.with_suffix(".csv")
+    else:
+        csv_path = cache_path
 
+    rows = load_cache(csv_path)
+    # decode each cached body once
+    parsed = {}
+    for dom, row in rows.items():
+        data = parse_cache_row(row)
+        if data:
+            parsed[dom] = data
+    return rows, parsed, use_pickle
 
-def write_success(success_path: Path, rows_by_domain: Dict[str, Dict[str, str]]):
+
+def write_success(success_path: Path, parsed_by_domain: Dict[str, Dict[str, Any]]):
     import csv
 
-    fieldnames = ["domain", "icp_name", "icp_num", "sitename", "service", "status"]
-    parsed = []
-    for row in rows_by_domain.values():
-        if row.get("status_code") != "200":
-            continue
-        data = parse_success(row.get("body", ""))
-            
-        if not data:
-            continue
-        parsed.append({
-            "domain": data.get("domain", ""),
-            "icp_name": data.get("icp_name", ""),
-            "icp_num": data.get("icp_num", ""),
-            "sitename": data.get("sitename", ""),
-            "service": data.get("service", ""),
-            "status": data.get("status", ""),
-        })
-
-    with success_path.open("w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(parsed)
-
-
-def update_workbook(workbook_path: Path, success_rows: Dict[str, Tuple[str, str]], link_header: str = "链接"):
+    rows = [[data.get(name, "") for name in SUCCESS_FIELDS] for data in parsed_by_domain.values()]
+    with success_path.open("w", newline="", encoding="utf-8", errors="surrogateescape", buffering=CSV_BUFFER_SIZE) as f:
+        writer = csv.writer(f)
+        writer.writerow(SUCCESS_FIELDS)
+        writer.writerows(rows)
+
+
+def replace_atomic(target: Path, write: Callable[[str], None]):
+    # write next to the target and swap it in, so a failed write never truncates it
+    fd, tmp_name = tempfile.mkstemp(suffix=target.suffix, dir=target.parent)
+    os.close(fd)
+    try:
+        write(tmp_name)
+        if target.exists():
+            shutil.copymode(target, tmp_name)
+        os.replace(tmp_name, target)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
+def save_workbook_atomic(wb: openpyxl.Workbook, workbook_path: Path):
+    # save_workbook() stamps this before handing off to ExcelWriter
+    wb.properties.modified = datetime.datetime.now(tz=datetime.timezone.utc).replace(tzinfo=None)
+
+    def write(tmp_name: str):
+        # like wb.save(), but with deflate level 1
+        with zipfile.ZipFile(tmp_name, "w", zipfile.ZIP_DEFLATED, allowZip64=True, compresslevel=1) as archive:
+            ExcelWriter(wb, archive).save()
+
+    replace_atomic(workbook_path, write)
+
+
+def resolve_fills(success_rows: Dict[str, Tuple[str, str]], row_to_domain: Dict[int, str]) -> Dict[int, Tuple[str, str]]:
+    return {row_idx: success_rows[dom] for row_idx, dom in row_to_domain.items() if dom in success_rows}
+
+
+def workbook_state(workbook_path: Path, fills: Dict[int, Tuple[str, str]]) -> Dict[str, Any]:
+    # file identity plus a digest of the written values
+    stat = workbook_path.stat()
+    digest = hashlib.sha1(json.dumps(sorted(fills.items()), ensure_ascii=False).encode("utf-8", "surrogateescape")).hexdigest()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "fills": digest}
+
+
+def read_state(state_path: Path) -> Dict[str, Any]:
+    try:
+        return json.loads(state_path.read_text(encoding="utf-8"))
+    except Exception:
+        return {}
+
+
+def write_state(state_path: Path, state: Dict[str, Any]):
+    try:
+        state_path.write_text(json.dumps(state), encoding="utf-8")
+    except OSError:
+        pass  # only an optimization for the next run
+
+
+def cell_text(value: Any) -> Any:
+    # lxml refuses lone surrogates
+    if isinstance(value, str):
+        return value.encode("utf-8", "surrogateescape").decode("utf-8", "replace")
+    return value
+
+
+def update_workbook(workbook_path: Path, fills: Dict[int, Tuple[str, str]]):
     wb = openpyxl.load_workbook(workbook_path)
     ws = cast(Worksheet, wb.active)
+    if fills and max(fills) > ws.max_row:
+        raise ValueError(f"Row {max(fills)} is outside the sheet ({ws.max_row} rows); refusing to write back")
 
     max_col = ws.max_column
     subject_col = max_col + 1
@@ -142,35 +448,11 @@ def update_workbook(workbook_path: Path, success_rows: Dict[str, Tuple[str, str]
     ws.cell(row=1, column=subject_col, value="备案主体")
     ws.cell(row=1, column=num_col, value="备案号")
 
-    # locate column index again
-    header_row = [c.value for c in next(ws.iter_rows(min_row=1, max_row=1))]
-    col_idx = None
-    for idx, val in enumerate(header_row):
-        if val == link_header:
-            col_idx = idx
-            break
-    if col_idx is None:
-        col_idx = 0
+    for row_idx, (subject, number) in fills.items():
+        ws.cell(row=row_idx, column=subject_col, value=cell_text(subject))
+        ws.cell(row=row_idx, column=num_col, value=cell_text(number))
 
-    for row in ws.iter_rows(min_row=2, max_row=ws.max_row):
-        if not row:
-            continue
-        cell_val = row[col_idx].value
-        if cell_val is None:
-            continue
-        text = str(cell_val).strip()
-        m = DOMAIN_PATTERN.search(text)
-        domain = m.group(0).lower() if m else text.lower()
-        info = success_rows.get(domain)
-        if not info:
-            continue
-        row_idx = row[0].row
-        if row_idx is None:
-            continue
-        ws.cell(row=row_idx, column=subject_col, value=info[0])
-        ws.cell(row=row_idx, column=num_col, value=info[1])
-
-    wb.save(workbook_path)
+    save_workbook_atomic(wb, workbook_path)
 
 
 def read_appcode_file(path: Path) -> str:
@@ -366,11 +648,20 @@ def main():
     parser = argparse.ArgumentParser(description="Batch ICP query with cache-first strategy")
     parser.add_argument("--workbook", default="domains.xlsx", help="Workbook to process")
     parser.add_argument("--cache", default="icp_results.csv", help="Cache file path")
+    parser.add_argument(
+        "--cache-format",
+        choices=["csv", "pickle"],
+        default="csv",
+        help="Cache storage; pickle keeps parsed responses in --cache with a .pkl suffix",
+    )
+    parser.add_argument("--export-csv", default="", help="Also write the raw cache rows to this CSV path")
     parser.add_argument("--success", default="icp_success.csv", help="Parsed success output")
     parser.add_argument("--host", default="https://domainicp.market.alicloudapi.com", help="API host")
     parser.add_argument("--path", default="/do", help="API path")
     parser.add_argument("--appcode", default=os.getenv("APP_CODE"), help="AppCode (or set APP_CODE env/appcode.txt)")
-    parser.add_argument("--sleep", type=float, default=0.1, help="Sleep between API calls (seconds)")
+    parser.add_argument("--sleep", type=float, default=0.1, help="Minimum interval between API call starts (seconds)")
+    parser.add_argument("--concurrency", type=int, default=5, help="Number of API calls in flight")
+    parser.add_argument("--http2", action="store_true", help="Multiplex API calls over HTTP/2 (needs httpx[http2])")
     parser.add_argument("--gui", action="store_true", help="Force GUI mode")
     args = parser.parse_args()
 
@@ -391,74 +682,84 @@ def main():
         success_path = Path(args.success)
         if args.cache == "icp_results.csv" and not cache_path.is_absolute():
             cache_path = workbook_path.parent / cache_path.name
+        if args.cache_format == "pickle":
+            cache_path = cache_path.with_suffix(".pkl")
         if args.success == "icp_success.csv" and not success_path.is_absolute():
             success_path = workbook_path.parent / success_path.name
 
-        domains = extract_domains(workbook_path)
+        domains, row_to_domain = extract_domains(workbook_path)
         ui.update(0, f"已提取域名 {len(domains)} 条")
 
-        cache = load_cache(cache_path)
+        cache, parsed, rebuild_cache = load_cache_entries(
+            cache_path, args.cache_format == "pickle", lambda msg: ui.update(0, msg)
+        )
 
-        to_call = []
-        for dom in domains:
-            row = cache.get(dom)
-            if not row:
-                to_call.append(dom)
-                continue
-            if row.get("status_code") != "200":
-                to_call.append(dom)
-                continue
-            if not parse_success(row.get("body", "")):
-                to_call.append(dom)
+        to_call = [dom for dom in domains if dom not in parsed]
 
         ui.update(0, f"需要调用 API {len(to_call)} 次")
 
-        sess = requests.Session()
+        concurrency = max(1, args.concurrency)
+        sess: HttpClient = None
+        if args.http2:
+            try:
+                sess = make_http2_client(concurrency)
+            except ImportError:
+                ui.update(0, "未安装 httpx[http2]，使用 HTTP/1.1")
+        if sess is None:
+            sess = make_session(concurrency)
+        url = f"{args.host}{args.path}"
+        headers = {"Authorization": f"APPCODE {appcode}"}
         errors = 0
         start_time = time.monotonic()
         ui.total = max(1, len(to_call))
         if ui.use_gui and ui.progress:
             ui.progress["maximum"] = ui.total
 
-        for idx, dom in enumerate(to_call, 1):
-            try:
-                cache[dom] = call_api(dom, appcode, args.host, args.path, sess)
-                if cache[dom].get("status_code") != "200":
+        results: Dict[str, Dict[str, Any]] = {}
+        try:
+            for idx, (dom, row) in enumerate(iter_api_results(to_call, url, headers, sess, concurrency, RateLimiter(args.sleep)), 1):
+                results[dom] = row
+                if row.get("status_code") != 200:
                     errors += 1
-            except Exception as e:
-                cache[dom] = {
-                    "domain": dom,
-                    "status_code": "-1",
-                    "error_header": type(e).__name__,
-                    "body": str(e),
-                }
-                errors += 1
-
-            elapsed = time.monotonic() - start_time
-            avg = elapsed / idx if idx else 0
-            remaining = avg * (len(to_call) - idx)
-            msg = f"处理中 {idx}/{len(to_call)} | 已用 {format_seconds(elapsed)} | 预计剩余 {format_seconds(remaining)}"
-            ui.update(idx, msg)
-            time.sleep(args.sleep)
 
-        # rewrite cache in domain order
-        rewrite_cache(cache_path, domains, cache)
+                elapsed = time.monotonic() - start_time
+                avg = elapsed / idx if idx else 0
+                remaining = avg * (len(to_call) - idx)
+                msg = f"处理中 {idx}/{len(to_call)} | 已用 {format_seconds(elapsed)} | 预计剩余 {format_seconds(remaining)}"
+                ui.update(idx, msg)
+        finally:
+            # release pooled connections on errors too
+            sess.close()
+
+        # merge in submission order so output files stay in workbook order
+        for dom in to_call:
+            cache[dom] = results[dom]
+            data = parse_cache_row(results[dom])
+            if data:
+                parsed[dom] = data
+        parsed = {dom: parsed[dom] for dom in cache if dom in parsed}
+
+        # rewrite cache in domain order, unless unchanged
+        if rebuild_cache or to_call or list(cache) != domains:
+            if args.cache_format == "pickle":
+                rewrite_cache_pickle(cache_path, domains, cache, parsed)
+            else:
+                rewrite_cache(cache_path, domains, cache)
+        if args.export_csv:
+            rewrite_cache(Path(args.export_csv), domains, cache)
 
         # build success map
-        success_map: Dict[str, Tuple[str, str]] = {}
-        for dom, row in cache.items():
-            if row.get("status_code") != "200":
-                continue
-            data = parse_success(row.get("body", ""))
-            if not data:
-                continue
-            success_map[dom] = (data.get("icp_name", ""), data.get("icp_num", ""))
+        success_map = {dom: (data.get("icp_name", ""), data.get("icp_num", "")) for dom, data in parsed.items()}
 
         # write success csv
-        write_success(success_path, cache)
-
-        # update workbook columns
-        update_workbook(workbook_path, success_map)
+        write_success(success_path, parsed)
+
+        # update workbook columns, unless already written
+        fills = resolve_fills(success_map, row_to_domain)
+        state_path = workbook_path.with_name(f".{workbook_path.name}.icp_state.json")
+        if read_state(state_path) != workbook_state(workbook_path, fills):
+            update_workbook(workbook_path, fills)
+            write_state(state_path, workbook_state(workbook_path, fills))
 
         summary = (
             f"完成。总计 {len(domains)} 条，API 调用 {len(to_call)} 次，失败 {errors} 次。\n"